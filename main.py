@@ -1,45 +1,307 @@
-import os, io, re, tempfile
+import os, io, re, sys, time, atexit, secrets, signal, asyncio, shutil, pathlib, tempfile, weakref, subprocess
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from datetime import datetime
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler, MessageHandler,
+    CallbackQueryHandler, ConversationHandler, ContextTypes, PicklePersistence, TypeHandler, filters
 )
 
 # DOCX
 from docx import Document
 from docx.shared import Pt, Inches
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
-# PDF (اختياري)
+# PDF (اختياري): docx2pdf يشغّل Microsoft Word فيشتغل بس على ويندوز/ماك،
+# وبغيرها (سيرفرات لينكس) نحوّل بـ LibreOffice إذا مثبّت
 try:
     from docx2pdf import convert as docx2pdf_convert
-    DOCX2PDF_AVAILABLE = True
+    DOCX2PDF_AVAILABLE = sys.platform in ("win32", "darwin")
 except Exception:
     DOCX2PDF_AVAILABLE = False
+SOFFICE = shutil.which("soffice") or shutil.which("libreoffice")
+PDF_AVAILABLE = DOCX2PDF_AVAILABLE or SOFFICE is not None
+
+# uvloop (اختياري – غير متوفر على ويندوز)
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except Exception:
+    UVLOOP_AVAILABLE = False
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# ملف حفظ حالة المحادثات حتى ما تضيع عند إعادة تشغيل البوت
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "bot_state.pickle")
+# إذا انضبط WEBHOOK_URL (مثلاً https://example.com) يشتغل البوت بالـ webhook بدل polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+PORT = int(os.getenv("PORT", "8443"))
+# تيليجرام يرسله بترويسة X-Telegram-Bot-Api-Secret-Token، والطلبات اللي بدونه تنرفض.
+# إذا ما انضبط ينولّد واحد عشوائي مع كل تشغيل (run_webhook يسجله مع الـ webhook)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# عدد عمليات التوليد المتوازية (0 = عدد أنوية المعالج)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or None
+# المحادثات المتروكة تنتهي وتنمسح بياناتها بعد هذي المدة (بالثواني).
+# مؤقتات الانتهاء ما تنحفظ بـ PicklePersistence: المحادثة اللي كانت مفتوحة وقت
+# إعادة التشغيل ما يجيها TIMEOUT، وتبقى بخطوتها لحد ما يكملها المستخدم أو يرسل /cancel
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "1800"))
 
 # محادثة
 (TITLE, LANG, STUDENT, PROFESSOR, UNIVERSITY, COLLEGE, DEPARTMENT,
  YEAR, PAGES, REFSTYLE, CONFIRM) = range(11)
 
 # أنماط المراجع المدعومة
-REF_STYLES = ["APA", "IEEE", "MLA", "Harvard", "Chicago"]
+REF_STYLES = ("APA", "IEEE", "MLA", "Harvard", "Chicago")
 
-def _slug(s: str) -> str:
-    return re.sub(r"[^A-Za-z0-9_\-]+", "_", s).strip("_")
+# بيانات أزرار اللغة والمراجع -> القيمة المخزنة
+LANG_CODES = {"lang_ar": "arabic", "lang_en": "english"}
+REF_CODES = {f"ref_{s}": s for s in REF_STYLES}
+
+# عدد الصفحات المسموح
+PAGES_RANGE = range(5, 41)
+
+# فلتر الرسائل النصية (بدون أوامر)، مشترك بين كل الخطوات
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
 
-def _set_paragraph_style(p):
-    p.paragraph_format.line_spacing = 1.5
-    for r in p.runs:
-        r.font.name = "Times New Roman"
-        r.font.size = Pt(14)
+RESTART_HINT = "\n\nللبدء من جديد أرسل /start"
+SESSION_EXPIRED = "انتهت الجلسة، أرسل /start للبدء من جديد."
+
+# معاينة البيانات قبل التأكيد
+SUMMARY_TMPL = (
+    "معاينة البيانات:\n"
+    "العنوان: {r.title}\nاللغة: {r.language}\nالطالب: {r.student}\n"
+    "الأستاذ: {r.professor}\nالجامعة: {r.university}\n"
+    "الكلية: {r.college}\nالقسم: {r.department}\n"
+    "السنة/المرحلة: {r.year}\nالصفحات: {r.pages}\n"
+    "نمط المراجع: {r.refstyle}\n\nتأكيد الإنشاء؟"
+)
+
+# الأزرار ثابتة، فتُبنى مرة وحدة عند التحميل
+LANG_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🇮🇶 العربية", callback_data="lang_ar")],
+    [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
+])
+REF_KB = InlineKeyboardMarkup([[InlineKeyboardButton(s, callback_data=f"ref_{s}") ] for s in REF_STYLES])
+# PDF اختياري: التحويل أثقل خطوة، فما نسويه إلا إذا طلبه المستخدم
+CONFIRM_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Word فقط", callback_data="go_docx")],
+    *([[InlineKeyboardButton("📄 Word + PDF", callback_data="go_both")]] if PDF_AVAILABLE else []),
+    [InlineKeyboardButton("❌ إلغاء", callback_data="cancel")],
+])
+
+# بيانات التقرير: ثابتة (ما تتغير أثناء التوليد) وقابلة للـ hash.
+# أثناء المحادثة تنحفظ بـ user_data["reports"][chat_id] وكل خطوة تبدلها بنسخة محدّثة
+@dataclass(frozen=True)
+class ReportRequest:
+    title: str = ""
+    language: str = "english"
+    student: str = ""
+    professor: str = ""
+    university: str = ""
+    college: str = ""
+    department: str = ""
+    year: str = ""
+    pages: int = 0
+    refstyle: str = "APA"
+
+# user_data مشترك بين كل دردشات المستخدم، فالتقرير ينحفظ لكل دردشة لحاله:
+# /start أو /cancel بمجموعة ما يمسح تقريره اللي بنص الطريق بالخاص
+def _reports(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    return context.user_data.setdefault("reports", {})
+
+def _set_report(update: Update, context: ContextTypes.DEFAULT_TYPE, report: ReportRequest) -> None:
+    _reports(context)[update.effective_chat.id] = report
+
+def _pop_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return _reports(context).pop(update.effective_chat.id, None)
+
+# يرجع None إذا ما كو تقرير محفوظ لهذي الدردشة (انمسح أو ما انحفظ)، وما ينشئ طلب فارغ
+def _update_report(update: Update, context: ContextTypes.DEFAULT_TYPE, **changes):
+    reports = _reports(context)
+    chat_id = update.effective_chat.id
+    report = reports.get(chat_id)
+    if report is None:
+        return None
+    report = reports[chat_id] = replace(report, **changes)
+    return report
+
+async def _session_expired(update: Update) -> int:
+    await update.effective_message.reply_text(SESSION_EXPIRED)
+    return ConversationHandler.END
+
+# التحديثات تتعالج بالتوازي بين المستخدمين، ومتسلسلة لنفس (الدردشة، المستخدم):
+# ConversationHandler ما عنده قفل، فرسائل نفس المحادثة لازم توصله بالترتيب.
+# وبالمجموعات كل مستخدم له تقريره بدون ما ينتظر غيره
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks = weakref.WeakValueDictionary()
+
+    # القفل ينمسك قبل فتحة الـ semaphore العامة: تحديثات مستخدم تنتظر دورها خلف
+    # توليد طويل ما تحجز فتحات، فباقي المستخدمين ما يتوقفون
+    async def process_update(self, update, coroutine) -> None:
+        chat = getattr(update, "effective_chat", None)
+        user = getattr(update, "effective_user", None)
+        if chat is None and user is None:
+            # تحديثات بدون دردشة أو مستخدم ما تخص محادثة، فما تحتاج ترتيب
+            await super().process_update(update, coroutine)
+            return
+        key = (chat and chat.id, user and user.id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        async with lock:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# كاش للتقارير المولّدة: نفس المدخلات بنفس اليوم ترجع نفس الملفات بدون إعادة توليد
+_RENDER_CACHE = OrderedDict()
+_RENDER_CACHE_SIZE = 32
+
+# تاريخ اليوم يتحدث كل دقيقة بدل ما ينحسب وينسّق مع كل تقرير
+_TODAY = [float("-inf"), ""]
+
+def _today() -> str:
+    now = time.monotonic()
+    if now - _TODAY[0] > 60:
+        _TODAY[0] = now
+        _TODAY[1] = datetime.now().strftime('%Y-%m-%d')
+    return _TODAY[1]
+
+def _cache_get(key):
+    hit = _RENDER_CACHE.get(key)
+    if hit is not None:
+        _RENDER_CACHE.move_to_end(key)
+    return hit
+
+def _cache_put(key, value) -> None:
+    _RENDER_CACHE[key] = value
+    if len(_RENDER_CACHE) > _RENDER_CACHE_SIZE:
+        _RENDER_CACHE.popitem(last=False)
+
+# الفهرس فقرة وحدة، كل مدخل بسطر (<w:br/>) بدل فقرة لكل مدخل
+_TOC_TEXT = "\n".join(("1. Introduction", "2. Main Body", "3. Conclusion", "4. References"))
+
+# نص المقدمة والخاتمة لكل لغة؛ المقدمة قالب يتعبأ من بيانات التقرير
+_INTRO = {
+    "english": (
+        "This report titled \"{r.title}\" explores the topic in a structured academic style. "
+        "It belongs to {r.department} / {r.college} at {r.university}."
+    ),
+    "arabic": (
+        "يتناول هذا التقرير بعنوان \"{r.title}\" الموضوع بصورة أكاديمية منظمة، "
+        "وهو تابع لـ {r.department} / {r.college} في {r.university}."
+    ),
+}
+_CONCLUSION = {
+    "english": "This report summarized the main ideas, practical implications, and suggested directions for future work.",
+    "arabic": "قدّم هذا التقرير خلاصةً للأفكار الأساسية والانعكاسات العملية مع مقترحات للعمل المستقبلي.",
+}
+
+# نقاط المتن الثابتة لكل لغة، تُحضّر مرة وحدة بدل كل تقرير
+_BODY_POINTS = {
+    "english": (
+        "Background & Importance",
+        "Key Concepts & Definitions",
+        "Methods / Approaches",
+        "Applications / Case Studies",
+        "Challenges & Future Work",
+    ),
+    "arabic": (
+        "الخلفية والأهمية",
+        "المفاهيم والتعاريف",
+        "المنهجيات/الأساليب",
+        "التطبيقات/دراسات الحالة",
+        "التحديات والاتجاهات المستقبلية",
+    ),
+}
+_BODY_BULLET = {
+    "english": "• Write a concise, well-argued paragraph for this point.",
+    "arabic": "• اكتب فقرة موجزة ومتماسكة لهذه النقطة.",
+}
+
+# مرجع واحد بقائمة المراجع
+@dataclass(frozen=True)
+class Reference:
+    author: str
+    year: str
+    title: str
+    source: str
+
+_SAMPLE_REFS = (
+    Reference(author="Doe, J.", year="2022", title="Sample Paper", source="Journal of Examples"),
+    Reference(author="Smith, A.", year="2021", title="Another Work", source="Conference on Samples"),
+)
 
-def build_docx(data: dict) -> bytes:
+# قالب سطر المرجع لكل نمط (النمط غير المعروف يرجع لـ APA)
+_REF_FORMATS = {
+    "APA":     "{r.author} ({r.year}). {r.title}. {r.source}.",
+    "IEEE":    "[{i}] {r.author}, \"{r.title}\", {r.source}, {r.year}.",
+    "MLA":     "{r.author} \"{r.title}\". {r.source}, {r.year}.",
+    "Harvard": "{r.author} ({r.year}). {r.title}. {r.source}.",
+    "Chicago": "{r.author}. {r.year}. {r.title}. {r.source}.",
+}
+
+# المراجع ثابتة، فأسطرها لكل نمط تتنسق مرة وحدة وتنحفظ
+@lru_cache(maxsize=None)
+def _reference_lines(refstyle: str) -> tuple:
+    fmt = _REF_FORMATS.get(refstyle, _REF_FORMATS["APA"])
+    return tuple(fmt.format(i=i, r=ref) for i, ref in enumerate(_SAMPLE_REFS, 1))
+
+# \w يشمل الحروف العربية، فعنوان عربي ما يطلع اسم ملف فارغ
+_SLUG_RE = re.compile(r"[^\w\-]+")
+
+# حد لكل مستخدم: 5 تقارير بالدقيقة، حتى سيل من الطلبات ما يستهلك كل عمليات التوليد
+_USER_LIMITERS = OrderedDict()
+_USER_LIMITERS_SIZE = 10_000
+
+def _user_limiter(user_id: int) -> AsyncLimiter:
+    limiter = _USER_LIMITERS.get(user_id)
+    if limiter is None:
+        limiter = _USER_LIMITERS[user_id] = AsyncLimiter(5, 60)
+        if len(_USER_LIMITERS) > _USER_LIMITERS_SIZE:
+            _USER_LIMITERS.popitem(last=False)
+    else:
+        _USER_LIMITERS.move_to_end(user_id)
+    return limiter
+
+def _slug(s: str) -> str:
+    return _SLUG_RE.sub("_", s).strip("_") or "report"
+
+# نمط فقرات المتن، ينضاف للقالب
+BODY_STYLE = "Body14"
+
+# الفراغ بين كتل الغلاف (بقدر ثلاث أسطر فارغة) كـ space_before بدل فقرات فاضية
+COVER_GAP = Pt(40)
+
+# اسم النمط: (الحجم، عريض، الخط)
+_COVER_STYLES = {
+    "CoverUniversity": (16, True, None),
+    "CoverCollege": (14, True, None),
+    "CoverDepartment": (13, True, None),
+    "CoverTitle": (22, True, None),
+    "CoverInfo": (12, None, "Times New Roman"),
+}
+
+# القالب (الهوامش وغيرها من الإعدادات الثابتة) يُبنى مرة وحدة عند التحميل،
+# وكل تقرير يفتح نسخة منه من الذاكرة بدل ما يبدأ من Document() ويعيد الإعداد
+def _make_template() -> bytes:
     doc = Document()
     # هوامش
     for s in doc.sections:
@@ -47,263 +309,379 @@ def build_docx(data: dict) -> bytes:
         s.bottom_margin = Inches(1)
         s.left_margin = Inches(1)
         s.right_margin = Inches(1)
+    # نمط فقرات المتن: التنسيق بـ styles.xml مرة وحدة بدل ما ينكتب على كل run
+    body = doc.styles.add_style(BODY_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    body.base_style = doc.styles["Normal"]
+    body.font.name = "Times New Roman"
+    body.font.size = Pt(14)
+    body.paragraph_format.line_spacing = 1.5
+    # عناوين الأقسام كلها بالوسط، فالمحاذاة تنكتب على النمط بدل كل عنوان
+    doc.styles["Heading 1"].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    # أنماط نص الغلاف (حرفية) حتى الـ runs تاخذ تنسيقها من اسم النمط بس
+    for name, (size, bold, font) in _COVER_STYLES.items():
+        st = doc.styles.add_style(name, WD_STYLE_TYPE.CHARACTER)
+        st.font.size = Pt(size); st.font.bold = bold
+        if font:
+            st.font.name = font
+    bio = io.BytesIO()
+    doc.save(bio)
+    return bio.getvalue()
+
+_TEMPLATE_BYTES = _make_template()
+
+def build_docx(data: ReportRequest, date: str) -> bytes:
+    doc = Document(io.BytesIO(_TEMPLATE_BYTES))
+    body = doc.styles[BODY_STYLE]
+    h1 = doc.styles["Heading 1"]
+    lang = data.language
 
     # الغلاف
     doc.add_paragraph()
     head = doc.add_paragraph()
     head.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    r = head.add_run(data["university"] or "University")
-    r.bold = True; r.font.size = Pt(16)
-
+    head.add_run(data.university or "University", "CoverUniversity")
     head.add_run("\n")
-    r = head.add_run(data["college"] or "College"); r.bold = True; r.font.size = Pt(14)
+    head.add_run(data.college or "College", "CoverCollege")
     head.add_run("\n")
-    r = head.add_run(data["department"] or "Department"); r.bold = True; r.font.size = Pt(13)
-
-    doc.add_paragraph("\n\n")
+    head.add_run(data.department or "Department", "CoverDepartment")
 
     title_p = doc.add_paragraph()
     title_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    r = title_p.add_run(f"\"{data['title']}\""); r.bold = True; r.font.size = Pt(22)
-
-    doc.add_paragraph("\n\n")
+    title_p.paragraph_format.space_before = COVER_GAP
+    title_p.add_run(f"\"{data.title}\"", "CoverTitle")
 
+    # بيانات الطالب بـ run واحد (السطور فواصل <w:br/>)
     info = doc.add_paragraph()
-    info.add_run(f"Student(s): {data['student']}\n")
-    info.add_run(f"Professor: {data['professor']}\n")
-    info.add_run(f"Stage/Year: {data['year']}\n")
-    info.add_run(f"Date: {datetime.now().strftime('%Y-%m-%d')}\n")
-    for r in info.runs:
-        r.font.name = "Times New Roman"; r.font.size = Pt(12)
+    info.paragraph_format.space_before = COVER_GAP
+    info.add_run(
+        f"Student(s): {data.student}\n"
+        f"Professor: {data.professor}\n"
+        f"Stage/Year: {data.year}\n"
+        f"Date: {date}\n",
+        "CoverInfo",
+    )
 
     doc.add_page_break()
 
     # فهرس (نصي مبسّط – المستخدم يقدر يولد TOC تلقائي من Word لاحقاً)
-    h = doc.add_heading("TABLE OF CONTENTS", level=1); h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    doc.add_paragraph("1. Introduction")
-    doc.add_paragraph("2. Main Body")
-    doc.add_paragraph("3. Conclusion")
-    doc.add_paragraph("4. References")
+    doc.add_paragraph("TABLE OF CONTENTS", style=h1)
+    doc.add_paragraph(_TOC_TEXT)
     doc.add_page_break()
 
     # مقدمة
-    h = doc.add_heading("Introduction", level=1); h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    intro = (
-        f"This report titled \"{data['title']}\" explores the topic in a structured academic style. "
-        f"It belongs to {data['department']} / {data['college']} at {data['university']}."
-        if data["language"] == "english" else
-        f"يتناول هذا التقرير بعنوان \"{data['title']}\" الموضوع بصورة أكاديمية منظمة، "
-        f"وهو تابع لـ {data['department']} / {data['college']} في {data['university']}."
-    )
-    p = doc.add_paragraph(intro); _set_paragraph_style(p)
+    doc.add_paragraph("Introduction", style=h1)
+    doc.add_paragraph(_INTRO[lang].format(r=data), style=body)
 
     # متن
     doc.add_page_break()
-    h = doc.add_heading("Main Body", level=1); h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-    bullets = [
-        ("Background & Importance" if data["language"]=="english" else "الخلفية والأهمية"),
-        ("Key Concepts & Definitions" if data["language"]=="english" else "المفاهيم والتعاريف"),
-        ("Methods / Approaches" if data["language"]=="english" else "المنهجيات/الأساليب"),
-        ("Applications / Case Studies" if data["language"]=="english" else "التطبيقات/دراسات الحالة"),
-        ("Challenges & Future Work" if data["language"]=="english" else "التحديات والاتجاهات المستقبلية"),
-    ]
-    for b in bullets:
-        p = doc.add_paragraph(b); p.runs[0].bold = True; _set_paragraph_style(p)
-        p = doc.add_paragraph(
-            "• " + (
-                "Write a concise, well-argued paragraph for this point."
-                if data["language"]=="english"
-                else "اكتب فقرة موجزة ومتماسكة لهذه النقطة."
-            )
-        ); _set_paragraph_style(p)
+    doc.add_paragraph("Main Body", style=h1)
+
+    bullet = _BODY_BULLET[lang]
+    for b in _BODY_POINTS[lang]:
+        p = doc.add_paragraph(b, style=body); p.runs[0].bold = True
+        doc.add_paragraph(bullet, style=body)
 
     # خاتمة
     doc.add_page_break()
-    h = doc.add_heading("Conclusion", level=1); h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    concl = (
-        "This report summarized the main ideas, practical implications, and suggested directions for future work."
-        if data["language"]=="english" else
-        "قدّم هذا التقرير خلاصةً للأفكار الأساسية والانعكاسات العملية مع مقترحات للعمل المستقبلي."
-    )
-    p = doc.add_paragraph(concl); _set_paragraph_style(p)
+    doc.add_paragraph("Conclusion", style=h1)
+    doc.add_paragraph(_CONCLUSION[lang], style=body)
 
     # مراجع
     doc.add_page_break()
-    h = doc.add_heading("References", level=1); h.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-    refs = [
-        {"author": "Doe, J.", "year": "2022", "title": "Sample Paper", "source": "Journal of Examples"},
-        {"author": "Smith, A.", "year": "2021", "title": "Another Work", "source": "Conference on Samples"},
-    ]
-    for i, ref in enumerate(refs, 1):
-        if data["refstyle"] == "IEEE":
-            line = f"[{i}] {ref['author']}, \"{ref['title']}\", {ref['source']}, {ref['year']}."
-        elif data["refstyle"] == "MLA":
-            line = f"{ref['author']} \"{ref['title']}\". {ref['source']}, {ref['year']}."
-        elif data["refstyle"] == "Harvard":
-            line = f"{ref['author']} ({ref['year']}). {ref['title']}. {ref['source']}."
-        elif data["refstyle"] == "Chicago":
-            line = f"{ref['author']}. {ref['year']}. {ref['title']}. {ref['source']}."
-        else:  # APA
-            line = f"{ref['author']} ({ref['year']}). {ref['title']}. {ref['source']}."
-        p = doc.add_paragraph(line); _set_paragraph_style(p)
+    doc.add_paragraph("References", style=h1)
+
+    for line in _reference_lines(data.refstyle):
+        doc.add_paragraph(line, style=body)
 
     bio = io.BytesIO()
     doc.save(bio); bio.seek(0)
     return bio.read()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _set_report(update, context, ReportRequest())
     await update.message.reply_text("أهلين! ارسل عنوان التقرير (Report Title).")
     return TITLE
 
-async def title_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["title"] = update.message.text.strip()
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🇮🇶 العربية", callback_data="lang_ar")],
-        [InlineKeyboardButton("🇬🇧 English", callback_data="lang_en")],
-    ])
-    await update.message.reply_text("اختار لغة التقرير:", reply_markup=kb)
-    return LANG
-
 async def lang_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    context.user_data["language"] = "arabic" if q.data=="lang_ar" else "english"
+    if _update_report(update, context, language=LANG_CODES.get(q.data, "english")) is None:
+        return await _session_expired(update)
     await q.message.reply_text("اكتب اسم الطالب (أو أسماء الطلاب).")
     return STUDENT
 
-async def student_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["student"] = update.message.text.strip()
-    await update.message.reply_text("اكتب اسم الدكتور/الأستاذ.")
-    return PROFESSOR
-
-async def professor_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["professor"] = update.message.text.strip()
-    await update.message.reply_text("اكتب اسم الجامعة.")
-    return UNIVERSITY
-
-async def university_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["university"] = update.message.text.strip()
-    await update.message.reply_text("اكتب اسم الكلية.")
-    return COLLEGE
-
-async def college_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["college"] = update.message.text.strip()
-    await update.message.reply_text("اكتب اسم القسم.")
-    return DEPARTMENT
-
-async def department_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["department"] = update.message.text.strip()
-    await update.message.reply_text("اكتب المرحلة/السنة الدراسية.")
-    return YEAR
+# خطوات النص البسيطة كلها نفس الشكل: نحفظ الحقل ونسأل السؤال التالي
+# (الحالة، الحقل، الحالة التالية، سؤال الخطوة التالية، أزرار السؤال)
+TEXT_STEPS = (
+    (TITLE,      "title",      LANG,       "اختار لغة التقرير:", LANG_KB),
+    (STUDENT,    "student",    PROFESSOR,  "اكتب اسم الدكتور/الأستاذ.", None),
+    (PROFESSOR,  "professor",  UNIVERSITY, "اكتب اسم الجامعة.", None),
+    (UNIVERSITY, "university", COLLEGE,    "اكتب اسم الكلية.", None),
+    (COLLEGE,    "college",    DEPARTMENT, "اكتب اسم القسم.", None),
+    (DEPARTMENT, "department", YEAR,       "اكتب المرحلة/السنة الدراسية.", None),
+    (YEAR,       "year",       PAGES,      "كم صفحة تريد؟ (بين 5 و 40)", None),
+)
 
-async def year_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["year"] = update.message.text.strip()
-    await update.message.reply_text("كم صفحة تريد؟ (بين 5 و 40)")
-    return PAGES
+def _make_text_step(field: str, next_state: int, prompt: str, markup=None):
+    async def step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if _update_report(update, context, **{field: update.message.text.strip()}) is None:
+            return await _session_expired(update)
+        await update.message.reply_text(prompt, reply_markup=markup)
+        return next_state
+    step.__name__ = step.__qualname__ = f"{field}_step"
+    return step
 
 async def pages_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        pages = int(update.message.text.strip())
-        if pages < 5 or pages > 40:
-            await update.message.reply_text("الرجاء رقم بين 5 و 40.")
-            return PAGES
-        context.user_data["pages"] = pages
-    except:
+    # isdecimal يقبل الأرقام العربية (١٢) أيضاً، و int() يفهمها
+    text = update.message.text.strip()
+    if not text.isdecimal():
         await update.message.reply_text("الرجاء إرسال رقم صحيح.")
         return PAGES
+    pages = int(text)
+    if pages not in PAGES_RANGE:
+        await update.message.reply_text("الرجاء رقم بين 5 و 40.")
+        return PAGES
+    if _update_report(update, context, pages=pages) is None:
+        return await _session_expired(update)
 
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton(s, callback_data=f"ref_{s}") ] for s in REF_STYLES])
-    await update.message.reply_text("اختر نمط المراجع:", reply_markup=kb)
+    await update.message.reply_text("اختر نمط المراجع:", reply_markup=REF_KB)
     return REFSTYLE
 
 async def ref_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    context.user_data["refstyle"] = q.data.replace("ref_","")
-    data = context.user_data
-    txt = (
-        f"معاينة البيانات:\n"
-        f"العنوان: {data['title']}\nاللغة: {data['language']}\nالطالب: {data['student']}\n"
-        f"الأستاذ: {data['professor']}\nالجامعة: {data['university']}\n"
-        f"الكلية: {data['college']}\nالقسم: {data['department']}\n"
-        f"السنة/المرحلة: {data['year']}\nالصفحات: {data['pages']}\n"
-        f"نمط المراجع: {data['refstyle']}\n\nتأكيد الإنشاء؟"
-    )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ نعم", callback_data="go")],
-        [InlineKeyboardButton("❌ إلغاء", callback_data="cancel")],
-    ])
-    await q.message.reply_text(txt, reply_markup=kb)
+    report = _update_report(update, context, refstyle=REF_CODES.get(q.data, "APA"))
+    if report is None:
+        return await _session_expired(update)
+    await q.message.reply_text(SUMMARY_TMPL.format(r=report), reply_markup=CONFIRM_KB)
     return CONFIRM
 
+# بروفايل LibreOffice ثابت لكل عملية: أول تحويل ينشئه وما بعده يبدأ دافي بدون إعادة إنشائه.
+# كل عملية بالـ pool تحوّل تقرير واحد بالمرة، فالتحويلات المتزامنة ما تتصادم على نفس البروفايل.
+# البروفايلات كلها داخل مجلد الـ pool، فعامل ينقتل (SIGKILL) ما يخلّي بروفايله: المجلد ينمسح مع الـ pool
+_LO_PROFILE_ROOT = [None]
+_LO_PROFILE = [None]
+
+def _init_render_worker(profile_root: str) -> None:
+    _LO_PROFILE_ROOT[0] = profile_root
+
+def _lo_profile() -> str:
+    if _LO_PROFILE[0] is None:
+        _LO_PROFILE[0] = tempfile.mkdtemp(prefix="lo_profile_", dir=_LO_PROFILE_ROOT[0])
+    return pathlib.Path(_LO_PROFILE[0]).as_uri()
+
+def _drop_lo_profile() -> None:
+    d, _LO_PROFILE[0] = _LO_PROFILE[0], None
+    if d is not None:
+        shutil.rmtree(d, ignore_errors=True)
+
+def _soffice_convert(path_docx: str, outdir: str) -> None:
+    # على لينكس soffice سكربت/oosplash يشغّل soffice.bin، فيشتغل بمجموعة عمليات خاصة
+    # وعند انتهاء المهلة تنقتل المجموعة كلها حتى ما يبقى soffice.bin يتيم
+    proc = subprocess.Popen(
+        [SOFFICE, f"-env:UserInstallation={_lo_profile()}", "--headless",
+         "--convert-to", "pdf", "--outdir", outdir, path_docx],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+    try:
+        try:
+            rc = proc.wait(timeout=120)
+        except subprocess.TimeoutExpired:
+            if hasattr(os, "killpg"):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+            proc.wait()
+            raise
+        if rc:
+            raise subprocess.CalledProcessError(rc, proc.args)
+    except Exception:
+        # تحويل فاشل أو مقطوع ممكن يخرب البروفايل، فينمسح والجاي يبدأ ببروفايل جديد
+        _drop_lo_profile()
+        raise
+
+# يبني ملف Word ويحاول تحويله لـ PDF إذا انطلب. يرجع (docx_bytes, pdf_bytes أو None).
+# التاريخ يجي من عملية البوت حتى يطابق مفتاح الكاش (العامل ما يحسبه بنفسه)
+def _render_report(data: ReportRequest, date: str, with_pdf: bool = True):
+    docx_bytes = build_docx(data, date)
+    if not (with_pdf and PDF_AVAILABLE):
+        return docx_bytes, None
+
+    base = _slug(f"{data.title}")
+    with tempfile.TemporaryDirectory() as td:
+        path_docx = os.path.join(td, f"{base}.docx")
+        path_pdf = os.path.join(td, f"{base}.pdf")
+        with open(path_docx, "wb") as f: f.write(docx_bytes)
+        try:
+            if DOCX2PDF_AVAILABLE:
+                docx2pdf_convert(path_docx, path_pdf)
+            else:
+                _soffice_convert(path_docx, td)
+            with open(path_pdf, "rb") as f:
+                return docx_bytes, f.read()
+        except Exception:
+            return docx_bytes, None
+
+# بناء python-docx شغل CPU يمسك الـ GIL، فيشتغل بعمليات منفصلة حتى التقارير المتزامنة تستخدم كل الأنوية
+# عامل يموت (نفاد ذاكرة أو انهيار أثناء تحويل soffice) يكسر الـ pool كله، فيتبدل بواحد جديد
+# [pool، مجلد بروفايلات LibreOffice لعماله]
+_RENDER_POOL = [None, None]
+
+def _render_pool() -> ProcessPoolExecutor:
+    if _RENDER_POOL[0] is None:
+        root = tempfile.mkdtemp(prefix="lo_profiles_")
+        atexit.register(shutil.rmtree, root, True)
+        _RENDER_POOL[0] = ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=_init_render_worker,
+                                              initargs=(root,))
+        _RENDER_POOL[1] = root
+    return _RENDER_POOL[0]
+
+def _reset_render_pool(pool: ProcessPoolExecutor) -> None:
+    # أكثر من طلب ممكن يلقى نفس الـ pool مكسور، فبس أول واحد يبدله
+    if _RENDER_POOL[0] is pool:
+        root = _RENDER_POOL[1]
+        _RENDER_POOL[0] = _RENDER_POOL[1] = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        shutil.rmtree(root, ignore_errors=True)
+
 async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     if q.data == "cancel":
+        _pop_report(update, context)
         await q.message.reply_text("تم الإلغاء.")
         return ConversationHandler.END
 
-    data = context.user_data
-    # توليد DOCX
-    docx_bytes = build_docx(data)
-
-    # اسم ملف
-    base = _slug(f"{data['title']}")
-    docx_name = f"{base}.docx"
-    pdf_name  = f"{base}.pdf"
-
-    # أرسل DOCX
-    await q.message.reply_document(document=io.BytesIO(docx_bytes), filename=docx_name,
-                                   caption="تم إنشاء تقرير Word ✅")
+    # pop بدل get: ضغطتين على التأكيد وحدة بس تاخذ الطلب، والثانية تلقى الجلسة منتهية
+    # بدل ما تولّد تقرير فارغ
+    data = _pop_report(update, context)
+    if data is None:
+        return await _session_expired(update)
+
+    want_pdf = q.data == "go_both" and PDF_AVAILABLE
+    # التاريخ ينحسب مرة وحدة هنا: جزء من مفتاح الكاش لأنه مطبوع على الغلاف،
+    # ونفسه ينطبع بالتقرير حتى قرب منتصف الليل ما ينحفظ تقرير أمس بمفتاح اليوم
+    date = _today()
+    key = (data, date)
+    # عنصر الكاش [docx, pdf]: كل واحد إما bytes أو file_id بعد أول رفع،
+    # والـ pdf يبقى None إذا ما انطلب أو فشل، فينعاد توليده أول ما ينطلب
+    cached = _cache_get(key)
+    need_render = cached is None or (want_pdf and cached[1] is None)
+    if need_render:
+        # الحد يُحسب على التوليد بس؛ إعادة إرسال file_id من الكاش ما تكلف شي
+        limiter = _user_limiter(update.effective_user.id)
+        if not limiter.has_capacity():
+            # نبقى بنفس الخطوة حتى يضغط تأكيد مرة ثانية بعد شوي
+            _set_report(update, context, data)
+            await q.message.reply_text("طلبات كثيرة خلال دقيقة. انتظر قليلاً ثم اضغط تأكيد مرة ثانية.")
+            return CONFIRM
+        await limiter.acquire()
 
-    # حاول PDF إذا متاح
-    if DOCX2PDF_AVAILABLE:
-        with tempfile.TemporaryDirectory() as td:
-            path_docx = os.path.join(td, docx_name)
-            with open(path_docx, "wb") as f: f.write(docx_bytes)
+    try:
+        if need_render:
+            # التوليد ثقيل (DOCX + تحويل PDF) فيشتغل خارج حلقة الأحداث حتى ما يوقف باقي المحادثات
+            loop = asyncio.get_running_loop()
+            pool = _render_pool()
             try:
-                docx2pdf_convert(path_docx, os.path.join(td, pdf_name))
-                with open(os.path.join(td, pdf_name), "rb") as f:
-                    await q.message.reply_document(document=io.BytesIO(f.read()), filename=pdf_name,
-                                                   caption="نسخة PDF ✅")
-            except Exception:
-                await q.message.reply_text("لم يتمكن البوت من توليد PDF على هذا الخادم. أرسلنا ملف Word فقط.")
-    else:
-        await q.message.reply_text("تحويل PDF غير مفعّل على هذا النظام. تم إرسال ملف Word فقط.")
+                docx_bytes, pdf_bytes = await loop.run_in_executor(pool, _render_report, data, date, want_pdf)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    _reset_render_pool(pool)
+                _set_report(update, context, data)
+                await q.message.reply_text("صار خطأ أثناء إنشاء التقرير. اضغط تأكيد مرة ثانية.")
+                return CONFIRM
+            if cached is None:
+                cached = [docx_bytes, pdf_bytes]
+                _cache_put(key, cached)
+            else:
+                cached[1] = pdf_bytes
+        docx_doc = cached[0]
+        pdf_doc = cached[1] if want_pdf else None
+
+        # اسم ملف
+        base = _slug(f"{data.title}")
+        docx_name = f"{base}.docx"
+        pdf_name  = f"{base}.pdf"
+
+        # نحتفظ بالـ file_id حتى الإرسال الجاي لنفس التقرير ما يعيد رفع الملف.
+        # الرفع بالترتيب: Word أول وبعده PDF، وكل file_id ينحفظ أول ما يوصل ملفه.
+        # ما نرفعهم سوا (gather): ترتيب الرسالتين يصير عشوائي، ولو فشل رفع يبقى الثاني
+        # شغال والكاش ينحفظ نصه. الفرق بالوقت رفع ملف صغير وحد
+        docx_caption = "تم إنشاء تقرير Word ✅"
+        if q.data == "go_docx":
+            docx_caption += RESTART_HINT
+        sent = await q.message.reply_document(document=docx_doc, filename=docx_name,
+                                              caption=docx_caption)
+        cached[0] = sent.document.file_id
+
+        # تلميح البدء من جديد يندمج بآخر رسالة بدل رسالة مستقلة
+        if pdf_doc is not None:
+            sent = await q.message.reply_document(document=pdf_doc, filename=pdf_name,
+                                                  caption="نسخة PDF ✅" + RESTART_HINT)
+            cached[1] = sent.document.file_id
+        elif want_pdf:
+            await q.message.reply_text("لم يتمكن البوت من توليد PDF على هذا الخادم. أرسلنا ملف Word فقط." + RESTART_HINT)
+        elif q.data == "go_both":
+            await q.message.reply_text("تحويل PDF غير مفعّل على هذا النظام. تم إرسال ملف Word فقط." + RESTART_HINT)
+    except Exception:
+        # الطلب يرجع مكانه والمحادثة تبقى بخطوة التأكيد، فالمستخدم يقدر يعيد المحاولة
+        _set_report(update, context, data)
+        raise
 
-    await q.message.reply_text("للبدء من جديد أرسل /start")
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _pop_report(update, context)
     await update.message.reply_text("ألغينا العملية. أرسل /start للبدء من جديد.")
     return ConversationHandler.END
 
+async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _pop_report(update, context)
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN غير موجود. ضعه كمتغير بيئة.")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    # حلقة أحداث أسرع للشبكة والمؤقتات إذا متوفرة
+    if UVLOOP_AVAILABLE:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # concurrent_updates: محادثة مستخدم ما تنتظر توليد تقرير مستخدم آخر،
+    # ورسائل نفس المستخدم تبقى بالترتيب (PerUserUpdateProcessor)
+    # rate_limiter: الرسائل الصادرة تنتظر بالطابور بدل ما تتجاوز حد تيليجرام (~30 رسالة/ثانية) وتاخذ 429
+    app = (
+        Application.builder().token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .persistence(PicklePersistence(filepath=PERSISTENCE_FILE))
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1,
+                                     group_max_rate=18, group_time_period=60))
+        .build()
+    )
 
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, title_step)],
+            **{state: [MessageHandler(TEXT_FILTER, _make_text_step(field, nxt, prompt, markup))]
+               for state, field, nxt, prompt, markup in TEXT_STEPS},
             LANG:  [CallbackQueryHandler(lang_cb, pattern="^lang_")],
-            STUDENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, student_step)],
-            PROFESSOR: [MessageHandler(filters.TEXT & ~filters.COMMAND, professor_step)],
-            UNIVERSITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, university_step)],
-            COLLEGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, college_step)],
-            DEPARTMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, department_step)],
-            YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, year_step)],
-            PAGES: [MessageHandler(filters.TEXT & ~filters.COMMAND, pages_step)],
+            PAGES: [MessageHandler(TEXT_FILTER, pages_step)],
             REFSTYLE: [CallbackQueryHandler(ref_cb, pattern="^ref_")],
-            CONFIRM: [CallbackQueryHandler(confirm_cb, pattern="^(go|cancel)$")],
+            CONFIRM: [CallbackQueryHandler(confirm_cb, pattern="^(go_docx|go_both|cancel)$")],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
         per_chat=True,
+        name="report",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     app.add_handler(conv)
-    app.run_polling()
+    if WEBHOOK_URL:
+        # تيليجرام يدفع التحديثات مباشرة، بدون تأخير ودورات getUpdates
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=BOT_TOKEN,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+                        secret_token=WEBHOOK_SECRET)
+    else:
+        # long polling: كل طلب getUpdates ينتظر لحد 30 ثانية بدل ما يرجع فارغ ويتكرر
+        app.run_polling(timeout=30)
 
 if __name__ == "__main__":
     main()